@@ -9,7 +9,7 @@ r"""PushHosts - Push HOSTS file to Windows endpoints.
                       \/     \/       \/            \/            \/ 
 
  Use RTR API to push HOSTS file to endpoints across CID or host group
- FalconPy v1.0
+ FalconPy v1.6.5 or later, Python 3.9 or later
 
  CHANGE LOG
 
@@ -17,18 +17,29 @@ r"""PushHosts - Push HOSTS file to Windows endpoints.
  22/08/2023   v1.1    Add rollback capability and some bug fixes, tested with FalconPy 1.3.0
  31/08/2023   v1.2    Add RTR command to fix permissions to new HOSTS file
  04/09/2023   v1.3    Handle API auth errors
+ 15/10/2026   v1.4    Requires FalconPy 1.6.5+ (shared HTTP session) and Python 3.9+
+                      Push in RTR batches of up to 1000 hosts, started while hosts are still being fetched
+                      Fetch host group pages concurrently, look up the HOSTS file by hash server-side
+                      Fix permissions and flush DNS in a single runscript command
+                      Exit on failed host pages or incomplete host lists, report every failed batch id
 
 """
 # Import dependencies
 import datetime
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import islice
 from argparse import ArgumentParser, RawTextHelpFormatter
 
-version = "1.3"
+version = "1.4"
 
 # Define logging function
 def log(msg):
     """Print the log message to the terminal."""
-    print(datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") + '  ' + str(msg))
+    print(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()) + '  ' + str(msg) + '\n', end='')
 
 # Import SDK
 try:
@@ -40,13 +51,15 @@ try:
         HostGroup,
         SensorDownload
     )
+    from requests import Session
+    from requests.adapters import HTTPAdapter
 except ImportError as err:
     log(err)
     log("Python falconpy library is required.\n"
-        "Install with: python3 -m pip install crowdstrike-falconpy"
+        "Install with: python3 -m pip install \"crowdstrike-falconpy>=1.6.5\""
         )
     raise SystemExit("Python falconpy library is required.\n"
-                     "Install with: python3 -m pip install crowdstrike-falconpy"
+                     "Install with: python3 -m pip install \"crowdstrike-falconpy>=1.6.5\""
                      ) from err
 
 # Process command line arguments
@@ -65,12 +78,14 @@ req.add_argument("--falcon_client_secret",
 
 req.add_argument("--hosts_file",
                  help="Hash (sha256) of HOSTS file to deploy. Must be uploaded to 'PUT' files in the console.",
+                 type=str.lower,
                  required=True
                  )
 
 req.add_argument("--scope",
                  help="Which hosts to change, can be 'cid' or 'hostgroup'",
                  choices=['cid', 'hostgroup'],
+                 type=str.lower,
                  required=True
                  )
 
@@ -87,183 +102,284 @@ req.add_argument("-b", "--base_url",
 
 args = parser.parse_args()
 
-if args.scope.lower() not in ["cid", "hostgroup"]:
-    log("The scope needs to be 'cid' or 'hostgroup'")
-    raise SystemExit("The scope needs to be 'cid' or 'hostgroup'")
-
 
 # Main routine
 def main():  
     log(f"Starting execution of PushHosts v{version}")
 
+    # One pooled HTTP session shared by every service class, so connections and TLS handshakes are reused,
+    # and one worker pool shared by every phase of the run. The pool never nests tasks, so it cannot deadlock.
+    # Both are released on every exit path, and API calls still queued are cancelled if the run aborts.
+    with Session() as session:
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+        session.mount("https://", adapter)
+
+        executor = ThreadPoolExecutor(max_workers=8)
+        try:
+            push_hosts_file(session, executor)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    log("-- Finished launching RTR commands, please check progress in the RTR audit logs")
+    log("End")
+
+
+def push_hosts_file(session, executor):
+    """Validate the inputs, fetch the hosts in scope and push the HOSTS file to them."""
+    scope = args.scope
+    scope_id = args.scope_id
+    is_cid = scope == "cid"
+
     log("Authenticating to API")
     auth = OAuth2(client_id=args.falcon_client_id,
                   client_secret=args.falcon_client_secret,
-                  base_url=args.base_url
+                  base_url=args.base_url,
+                  session=session
                   )
 
-    # Check which CID the API client is operating in, as sanity check. Exit if operating CID does not match provided scope_id.
-    falcon = SensorDownload(auth_object=auth, base_url=args.base_url)
-    response = falcon.get_sensor_installer_ccid()
+    # Log in once up front. The service classes would otherwise each log in lazily from the worker threads below.
+    response = auth.login()
 
-    if response["status_code"] < 300:
-        log(f"-- Authentication correct.")
+    if response["status_code"] == 201:
+        log("-- Authentication correct.")
+    else:
+        message = f"-- Authentication error: {response['status_code']} - {auth.token_fail_reason}"
+        log(message)
+        raise SystemExit(message)
+
+    # Build the host paging call up front. The API call is resolved once here, so paging only calls fetch(offset=...)
+    batch_size = 5000 # 5000 is max supported by API
+
+    if is_cid:
+        falcon_hosts = Hosts(auth_object=auth, base_url=args.base_url)
+        fetch = partial(falcon_hosts.query_devices_by_filter_scroll,
+                        limit=batch_size,
+                        filter="platform_name:'Windows'"
+                        )
     else:
-        log(f"-- Authentication error: {response['status_code']} - {response['body']['errors'][0]['message']}")
-        raise SystemExit(f"-- Authentication error: {response['status_code']} - {response['body']['errors'][0]['message']}")
+        falcon_hosts = HostGroup(auth_object=auth, base_url=args.base_url)
+        fetch = partial(falcon_hosts.query_group_members,
+                        limit=batch_size,
+                        filter="platform_name:'Windows'",
+                        id=scope_id
+                        )
+
+    # The CID check, the HOSTS file lookup and the first page of hosts are independent, run them at once
+    falcon = SensorDownload(auth_object=auth, base_url=args.base_url)
+    falcon_admin = RealTimeResponseAdmin(auth_object=auth, base_url=args.base_url)
+
+    fut_ccid = executor.submit(falcon.get_sensor_installer_ccid)
+    fut_putfiles = executor.submit(falcon_admin.list_put_files, filter=f"sha256:'{args.hosts_file}'")
+    fut_hosts = executor.submit(fetch)
+
+    # Check which CID the API client is operating in, as sanity check. Exit if operating CID does not match provided scope_id.
+    response = fut_ccid.result()
+
+    if response["status_code"] >= 300:
+        message = f"Unable to retrieve the API client CID: {response['status_code']} - {response['body']['errors']}"
+        log(message)
+        raise SystemExit(message)
 
     current_cid = response["body"]["resources"][0][:-3]
-    if (args.scope.lower() == "cid" and (args.scope_id.lower() != current_cid.lower())):
-        log(f"The entered CID [{args.scope_id.upper()}] does not match the API client CID [{current_cid.upper()}].")
-        raise SystemExit(f"The entered CID [{args.scope_id.upper()}] does not match the API client CID [{current_cid.upper()}].")
+    if (is_cid and (scope_id.lower() != current_cid.lower())):
+        message = f"The entered CID [{scope_id.upper()}] does not match the API client CID [{current_cid.upper()}]."
+        log(message)
+        raise SystemExit(message)
 
 
     # Check that hosts file specified exists
-    falcon = RealTimeResponseAdmin(auth_object=auth, base_url=args.base_url)
+    put_file_ids = fut_putfiles.result()["body"]["resources"]
 
-    put_files = falcon.get_put_files_v2(ids=falcon.list_put_files()["body"]["resources"])["body"]["resources"]
+    if not put_file_ids:
+        message = f"The entered HOSTS file hash [{args.hosts_file}] does not exist."
+        log(message)
+        raise SystemExit(message)
 
-    found = False
+    response = falcon_admin.get_put_files_v2(ids=put_file_ids[:1])
 
-    for put_file in put_files:
-        if put_file['sha256'].lower() == args.hosts_file.lower():
-            found = True
-            filename = put_file['name']
-            log(f"The selected HOSTS file is: {put_file['name']} ({put_file['sha256']}), modified {put_file['modified_timestamp'][:19]} by {put_file['modified_by']}")
+    if response["status_code"] >= 300 or not response["body"]["resources"]:
+        message = f"Unable to retrieve the HOSTS file details: {response['status_code']} - {response['body']['errors']}"
+        log(message)
+        raise SystemExit(message)
 
-    if not found:
-        log(f"The entered HOSTS file hash [{args.hosts_file.lower()}] does not exist.")
-        raise SystemExit(f"The entered HOSTS file hash [{args.hosts_file.lower()}] does not exist.")     
+    put_file = response["body"]["resources"][0]
+    filename = put_file['name']
+    log(f"The selected HOSTS file is: {put_file['name']} ({put_file['sha256']}), modified {put_file['modified_timestamp'][:19]} by {put_file['modified_by']}")
 
 
-    # Fetch list of hosts
-    if args.scope.lower() == "cid":
-        log(f"Getting all hosts from CID [{args.scope_id}]")
-        falcon = Hosts(auth_object=auth, base_url=args.base_url)
-    else:
-        log(f"Getting all hosts from host group ID [{args.scope_id}]")
-        falcon = HostGroup(auth_object=auth, base_url=args.base_url)
+    # Commands to push HOSTS file
+
+    falcon = RealTimeResponse(auth_object=auth, base_url=args.base_url)
 
+    datestring = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d-%H-%M-%S.backup")
 
-    offset = ""
-    hosts_all = []
+    commands = [
+        (falcon.batch_active_responder_command, "cd", r"cd c:\windows\system32\drivers\etc"),
+        (falcon.batch_active_responder_command, "mv", f"mv hosts hosts.{datestring}"),
+        (falcon_admin.batch_admin_command, "put", f"put {filename}")
+    ]
 
-    while True:
-        batch_size = 5000 # 5000 is max supported by API
+    # The rename stays a native RTR command, so the put file name never passes through PowerShell
+    if filename.lower() != "hosts":
+        commands.append((falcon.batch_active_responder_command, "mv", f"mv {filename} hosts"))
+
+    # Fixing permissions and flushing the DNS cache run on the endpoint as a single script
+    commands.append((falcon_admin.batch_admin_command,
+                     "runscript",
+                     r"runscript -Raw=```ICACLS c:\windows\system32\drivers\etc\hosts /grant *S-1-5-32-545:RX; ipconfig /flushdns```"
+                     ))
 
-        if args.scope.lower() == "cid":
-            # Fetch all Windows CID hosts
-            response = falcon.query_devices_by_filter_scroll(offset=offset,
-                                                             limit=batch_size,
-                                                             filter="platform_name:'Windows'"
-                                                             )
+    def run_command(batch_id, method, base_command, command_string):
+        """Submit a single RTR command to a batch, exit on failure."""
+        response = method(batch_id=batch_id, base_command=base_command, command_string=command_string)
+        if response["status_code"] == 201:
+            log(f"-- [{batch_id}] Command: {command_string}")
         else:
-            # Fetch all Windows host group ID hosts
-            if offset == "":
-                response = falcon.query_group_members(limit=batch_size,
-                                                      filter="platform_name:'Windows'",
-                                                      id=args.scope_id
-                                                      )
-            else:
-                response = falcon.query_group_members(offset=offset,
-                                                      limit=batch_size,
-                                                      filter="platform_name:'Windows'",
-                                                      id=args.scope_id
-                                                      )
+            raise SystemExit(f"Error on batch {batch_id}, command '{command_string}', "
+                             f"Response: {response['status_code']} - {response['body']['errors']}"
+                             )
 
-        offset = response['body']['meta']['pagination']['offset']
+    def push_hosts(host_ids):
+        """Initiate an RTR batch for a chunk of hosts and run the HOSTS push command sequence on it."""
+        response = falcon.batch_init_sessions(host_ids=host_ids, queue_offline=True)
+        batch_id = response['body']['batch_id']
 
-        for host_id in response['body']['resources']:
-            hosts_all.append(host_id)
+        if batch_id:
+            log(f"Initiated RTR batch with id {batch_id} for {len(host_ids)} hosts")
+        else:
+            raise SystemExit(f"Unable to initiate RTR session with {len(host_ids)} hosts starting at host {host_ids[0]}, "
+                             f"Response: {response['status_code']} - {response['body']['errors']}"
+                             )
+
+        for method, base_command, command_string in commands:
+            run_command(batch_id, method, base_command, command_string)
+
+
+    # Each batch is pushed as soon as its hosts are fetched, so no session sits idle while paging continues.
+    # Pages are split into chunks so no single request carries the whole CID. RTR has no multi-command
+    # request, so the round-trips are overlapped across batches instead. Commands within a batch still go
+    # out in order. Once any push fails, no new pushes are scheduled.
+    chunk_size = 1000
+    push_futures = {}
+    push_failed = threading.Event()
+
+    def push_done(future):
+        """Stop scheduling new pushes once a push has failed."""
+        if not future.cancelled() and future.exception() is not None:
+            push_failed.set()
+
+    def schedule_pushes(page):
+        """Schedule a push for every chunk of a fetched page."""
+        for i in range(0, len(page), chunk_size):
+            if push_failed.is_set():
+                return
+            chunk = page[i:i + chunk_size]
+            future = executor.submit(push_hosts, chunk)
+            future.add_done_callback(push_done)
+            push_futures[future] = len(chunk)
+
+    def page_hosts(response):
+        """Return the host IDs of a fetched page, exit if the page request failed."""
+        if response["status_code"] >= 300:
+            message = f"Unable to fetch hosts: {response['status_code']} - {response['body']['errors']}"
+            log(message)
+            raise SystemExit(message)
+        return response['body']['resources']
+
+
+    # Fetch list of hosts, the first page of Windows hosts is already in
+    if is_cid:
+        log(f"Getting all hosts from CID [{scope_id}]")
+    else:
+        log(f"Getting all hosts from host group ID [{scope_id}]")
 
-        log(f"-- Fetched {len(response['body']['resources'])} hosts, "
-            f"{len(hosts_all)}/{response['body']['meta']['pagination']['total']}"
-            )
+    response = fut_hosts.result()
 
-        if len(hosts_all) >= int(response['body']['meta']['pagination']['total']):
-            break
+    page = page_hosts(response)
+    body = response['body']
+    pagination = body['meta']['pagination']
+    total = int(pagination['total'])
 
-    log(f"-- Retrieved a total of {str(len(hosts_all))} hosts")
+    page_size = len(page)
 
+    idx = page_size
+    schedule_pushes(page)
 
-    # Now that we have the host IDs, we create a batch RTR list of commands to execute it in all hosts
+    log(f"-- Fetched {page_size} hosts, {idx}/{total}")
 
-    falcon = RealTimeResponse(auth_object=auth, base_url=args.base_url)
-    falcon_admin = RealTimeResponseAdmin(auth_object=auth, base_url=args.base_url)
-    
+    if is_cid:
+        # The scroll API returns a continuation token with every page,
+        # so the remaining pages have to be fetched one after the other.
+        # The total can move during a long scroll, so the loop follows the latest page's total.
+        while idx < int(pagination['total']) and pagination['offset'] and page_size and not push_failed.is_set():
+            response = fetch(offset=pagination['offset'])
+
+            # A failed page exits here, so an empty page below only ever means the scroll is done
+            page = page_hosts(response)
+            body = response['body']
+            pagination = body['meta']['pagination']
+            page_size = len(page)
 
-    # Get batch id
+            idx += page_size
+            schedule_pushes(page)
 
-    response = falcon.batch_init_sessions(host_ids=hosts_all, queue_offline=True)
-    batch_id = response['body']['batch_id']
+            log(f"-- Fetched {page_size} hosts, {idx}/{total}")
 
-    if batch_id:
-        log(f"Initiated RTR batch with id {batch_id}")
+        total = int(pagination['total'])
     else:
-        raise SystemExit("Unable to initiate RTR session with hosts.")
+        # Host group members are paged by numeric offset, so the remaining pages are fetched concurrently.
+        # Only a few fetches are in flight at a time, so the pushes for pages already in share the pool.
+        fetch_window = 4
+        offsets = iter(range(batch_size, total, batch_size))
+        in_flight = deque(executor.submit(fetch, offset=offset) for offset in islice(offsets, fetch_window))
 
+        while in_flight and not push_failed.is_set():
+            response = in_flight.popleft().result()
 
-    # Commands to push HOSTS file
+            offset = next(offsets, None)
+            if offset is not None:
+                in_flight.append(executor.submit(fetch, offset=offset))
 
-    response = falcon.batch_active_responder_command(batch_id=batch_id,
-                                                        base_command="cd",
-                                                        command_string=f"cd c:\windows\system32\drivers\etc"
-                                                        )
-    if response["status_code"] == 201:
-        log(f"-- Command: cd c:\windows\system32\drivers\etc")
-    else:
-        raise SystemExit(f"Error, Response: {response['status_code']} - {response.text}")
+            page = page_hosts(response)
+            page_size = len(page)
 
-    datestring = datetime.datetime.utcnow().strftime("%Y-%m-%d-%H-%M-%S.backup")
-    response = falcon.batch_active_responder_command(batch_id=batch_id,
-                                                        base_command="mv",
-                                                        command_string=f"mv hosts hosts." + datestring
-                                                        )
-    if response["status_code"] == 201:
-        log(f"-- Command: mv hosts hosts." + datestring)
-    else:
-        raise SystemExit(f"Error, Response: {response['status_code']} - {response.text}")
+            idx += page_size
+            schedule_pushes(page)
 
-    response = falcon_admin.batch_admin_command(batch_id=batch_id,
-                                                        base_command="put",
-                                                        command_string=f"put {filename}"
-                                                        )
-    if response["status_code"] == 201:
-        log(f"-- Command: put {filename}")
-    else:
-        raise SystemExit(f"Error, Response: {response['status_code']} - {response.text}")
+            log(f"-- Fetched {page_size} hosts, {idx}/{total}")
 
-    if filename.lower() != "hosts":
-        response = falcon.batch_active_responder_command(batch_id=batch_id,
-                                                            base_command="mv",
-                                                            command_string=f"mv {filename} hosts"
-                                                            )
-        if response["status_code"] == 201:
-            log(f"-- Command: mv {filename} hosts")
-        else:
-            raise SystemExit(f"Error, Response: {response['status_code']} - {response.text}")
 
-    response = falcon_admin.batch_admin_command(batch_id=batch_id,
-                                                        base_command="runscript",
-                                                        command_string="runscript -Raw=```ICACLS c:\windows\system32\drivers\etc\hosts /grant *S-1-5-32-545:RX```"
-                                                        )
-    if response["status_code"] == 201:
-        log("-- Command: run ICACLS c:\windows\system32\drivers\etc\hosts /grant *S-1-5-32-545:RX")
-     
+    # Wait for the scheduled pushes. Once one fails, the ones that have not started yet are cancelled.
+    for future in as_completed(push_futures):
+        if not future.cancelled() and future.exception() is not None:
+            for scheduled in push_futures:
+                scheduled.cancel()
 
+    failures = [future.exception() for future in push_futures
+                if not future.cancelled() and future.exception() is not None
+                ]
 
-    response = falcon_admin.batch_admin_command(batch_id=batch_id,
-                                                        base_command="runscript",
-                                                        command_string="runscript -Raw=```ipconfig /flushdns```"
-                                                        )
-    if response["status_code"] == 201:
-        log("-- Command: run ipconfig /flushdns")
-    else:
-        raise SystemExit(f"Error, Response: {response['status_code']} - {response.text}")
+    if failures:
+        for error in failures:
+            log(f"-- Failed: {error}")
+        started_hosts = sum(size for future, size in push_futures.items() if not future.cancelled())
+        message = (f"{len(failures)} RTR batches failed. {idx - started_hosts} of the {idx}/{total} hosts fetched "
+                   f"were not pushed. Check the failed batches above in the RTR audit logs."
+                   )
+        log(message)
+        raise SystemExit(message)
 
+    log(f"-- Retrieved a total of {idx} hosts")
 
-    log("-- Finished launching RTR commands, please check progress in the RTR audit logs")
-    log("End")
+    if idx != total:
+        message = f"Retrieved {idx} hosts but the API reported {total}, not all hosts in scope were reached."
+        log(message)
+        raise SystemExit(message)
+
+    if not push_futures:
+        raise SystemExit("Unable to initiate RTR session with hosts.")
+
+    log(f"-- Launched RTR commands on {len(push_futures)} batches of up to {chunk_size} hosts")
 
 if __name__ == "__main__":
     main()